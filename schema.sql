@@ -1,3 +1,7 @@
+DROP TABLE IF EXISTS snapshots;
+
+DROP TABLE IF EXISTS ledger;
+
 DROP TABLE IF EXISTS entries;
 
 DROP TABLE IF EXISTS accounts;
@@ -8,7 +12,8 @@ CREATE TABLE organizations (
     id SERIAL PRIMARY KEY,
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     domain TEXT NOT NULL UNIQUE,
-    settings JSONB NOT NULL
+    settings JSONB NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE TABLE accounts (
@@ -22,13 +27,56 @@ CREATE TABLE accounts (
     picture TEXT
 );
 
+-- Entries are split between a live partition and an archive partition.
+-- Expired entries with no residue left are moved to the archive by `src/archive.py`.
+-- Partitioned tables need the partition key in the primary key, so Postgres only guarantees
+-- (id, archived) is unique. Ids still are, since they all come from the one sequence and
+-- archiving moves rows without changing them.
 CREATE TABLE entries (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     account_id INTEGER NOT NULL REFERENCES accounts(id),
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     happened_on DATE NOT NULL,
     expires_on DATE NOT NULL,
     value SMALLINT NOT NULL,
     residue SMALLINT NOT NULL,
-    multiplier REAL NOT NULL
-);
\ No newline at end of file
+    multiplier REAL NOT NULL,
+    archived BOOLEAN NOT NULL DEFAULT FALSE,
+    client_id TEXT,
+    PRIMARY KEY (id, archived)
+) PARTITION BY LIST (archived);
+
+CREATE TABLE entries_live PARTITION OF entries FOR VALUES IN (FALSE);
+
+CREATE TABLE entries_archive PARTITION OF entries FOR VALUES IN (TRUE);
+
+CREATE INDEX ON entries (account_id, happened_on);
+
+CREATE INDEX ON entries (account_id, expires_on);
+
+-- Entries created offline carry an id generated by the client, so syncing them is idempotent.
+CREATE UNIQUE INDEX ON entries (account_id, client_id, archived);
+
+-- Append-only record of every change to entries' residue.
+CREATE TABLE ledger (
+    id BIGSERIAL PRIMARY KEY,
+    account_id INTEGER NOT NULL REFERENCES accounts(id),
+    entry_id INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    kind TEXT NOT NULL,
+    delta SMALLINT NOT NULL,
+    expires_on DATE NOT NULL
+);
+
+CREATE INDEX ON ledger (account_id, created_at);
+
+-- Open residues per account, folded from the ledger by `src/snapshot.py`.
+CREATE TABLE snapshots (
+    id SERIAL PRIMARY KEY,
+    account_id INTEGER NOT NULL REFERENCES accounts(id),
+    taken_at TIMESTAMPTZ NOT NULL,
+    balance INTEGER NOT NULL,
+    residues JSONB NOT NULL
+);
+
+CREATE INDEX ON snapshots (account_id, taken_at);
@@ -0,0 +1,23 @@
+from database import Session, archive_entries
+
+import config
+import logging
+import asyncio
+import datetime
+
+# Logger instance.
+log = logging.getLogger("archive")
+
+
+async def main():
+    before = datetime.date.today() - datetime.timedelta(days=config.ARCHIVE_AFTER)
+    async with Session() as session:
+        count = await archive_entries(session, before)
+        await session.commit()
+    log.info(f"Archived {count} entries that expired before {before}.")
+
+
+# Run once, e.g. daily from cron.
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -7,10 +7,18 @@ from sqlalchemy import (
     DateTime,
     Boolean,
     ForeignKey,
+    JSON,
+    BigInteger,
     func,
+    insert,
+    literal,
+    literal_column,
+    or_,
+    update,
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import (
+    aliased,
     declarative_base,
     relationship,
     column_property,
@@ -18,17 +26,31 @@ from sqlalchemy.orm import (
     UOWTransaction,
     Session as SyncSession,
 )
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.future import select
-from sqlalchemy.event import listens_for
+from sqlalchemy.event import listen, listens_for
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 
 from starlette.types import ASGIApp, Receive, Scope, Send
 from starlette.requests import Request
 
+from ext.cache import Cache
+
+import re
+import time
+import logging
 import datetime
 import config
 
+# Logger instance.
+log = logging.getLogger("database")
+
+# Row locking clauses, i.e. FOR UPDATE, FOR NO KEY UPDATE, FOR SHARE or FOR KEY SHARE.
+LOCKING_CLAUSE = re.compile(
+    r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|SHARE|KEY\s+SHARE)\b", re.I
+)
+
 # Base model.
 Base = declarative_base()
 
@@ -39,6 +61,54 @@ engine = create_async_engine(str(config.DATABASE_URL), echo=config.DEBUG, future
 Session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    """
+    Take note of when statement execution started.
+    """
+
+    context._started_at = time.perf_counter()
+
+
+def explain_slow_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Log statements slower than the threshold, along with their query plan.
+    Only plain SELECT statements are analyzed, since EXPLAIN ANALYZE executes them again.
+    The EXPLAIN runs in a savepoint so failing doesn't abort the request's transaction.
+    """
+
+    elapsed = (time.perf_counter() - context._started_at) * 1000
+
+    if elapsed < config.SLOW_QUERY_THRESHOLD or executemany:
+        return
+
+    is_select = statement.lstrip().upper().startswith("SELECT")
+    if is_select and not LOCKING_CLAUSE.search(statement):
+        explain = "EXPLAIN ANALYZE"
+    else:
+        explain = "EXPLAIN"
+
+    explain_cursor = conn.connection.cursor()
+    try:
+        explain_cursor.execute("SAVEPOINT explain_slow_statement")
+        explain_cursor.execute(f"{explain} {statement}", parameters)
+        plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+        explain_cursor.execute("RELEASE SAVEPOINT explain_slow_statement")
+    except Exception as exception:
+        plan = f"Couldn't explain statement: {exception}"
+        try:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_statement")
+        except Exception as exception:
+            log.exception(msg="Couldn't roll back savepoint", exc_info=exception)
+
+    log.warning(f"Slow statement ({elapsed:.0f}ms):\n{statement}\n{parameters}\n{plan}")
+
+
+# Capture slow statements, when enabled.
+if config.SLOW_QUERY_THRESHOLD:
+    listen(engine.sync_engine, "before_cursor_execute", start_statement_timer)
+    listen(engine.sync_engine, "after_cursor_execute", explain_slow_statement)
+
+
 async def all(self, query):
     """
     Shortcut to (await session.scalars(query)).all().
@@ -91,7 +161,11 @@ class Organization(Base):
     id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
     domain = Column(Text, nullable=False, unique=True, index=True)
-    settings = Column(JSONB, nullable=False, default=default_settings)
+    settings = Column(
+        JSONB().with_variant(JSON, "sqlite"), nullable=False, default=default_settings
+    )
+    # Data version, bumped whenever its accounts change, see bump_organization_versions().
+    version = Column(Integer, nullable=False, default=0)
     accounts = relationship("Account", back_populates="organization")
 
 
@@ -130,7 +204,10 @@ class Account(Base):
     def expiring_balance(self, a, b):
         return func.coalesce(
             func.sum(Entry.residue).filter(
-                Entry.not_expired, Entry.expires_on >= a, Entry.expires_on < b
+                Entry.live,
+                Entry.not_expired,
+                Entry.expires_on >= a,
+                Entry.expires_on < b,
             ),
             0,
         ).label("expiring_balance")
@@ -159,6 +236,8 @@ class Entry(Base):
     value = Column(Integer, nullable=False)
     residue = Column(Integer, nullable=False)
     multiplier = Column(Float, nullable=False)
+    archived = Column(Boolean, nullable=False, default=False)
+    client_id = Column(Text)
     account = relationship("Account", back_populates="entries")
 
     @hybrid_method
@@ -177,17 +256,25 @@ class Entry(Base):
     def not_expired(self):
         return self.expires_on >= datetime.date.today()
 
+    @hybrid_property
+    def live(self):
+        return not self.archived
+
+    @live.expression
+    def live(self):
+        return self.archived == False
+
     @hybrid_property
     def active(self):
-        return self.has_residue and self.not_expired
+        return self.live and self.has_residue and self.not_expired
 
     @active.expression
     def active(self):
-        return self.has_residue & self.not_expired
+        return self.live & self.has_residue & self.not_expired
 
     @hybrid_property
     def by_date(self):
-        return (self.happened_on.desc(), self.created_at.desc())
+        return (self.happened_on.desc(), self.created_at.desc(), self.id.desc())
 
     @hybrid_property
     def by_expiration(self):
@@ -204,6 +291,7 @@ class Entry(Base):
         entries = session.scalars(
             select(Entry)
             .where(
+                Entry.live,
                 Entry.account_id == self.account_id,
                 Entry.happened_on < self.expires_on,
                 Entry.expires_on > self.happened_on,
@@ -222,23 +310,459 @@ class Entry(Base):
             entry.residue, self.residue = 0, residue
 
 
+class LedgerEvent(Base):
+    """
+    Ledger event model. An append-only record of every change to entries' residue.
+    - `created` events carry the residue an entry started with.
+    - `settled` events carry how much an entry's residue changed by when matched against another.
+    """
+
+    __tablename__ = "ledger"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    account_id = Column(None, ForeignKey("accounts.id"))
+    entry_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    kind = Column(Text, nullable=False)
+    delta = Column(Integer, nullable=False)
+    expires_on = Column(Date, nullable=False)
+
+    @hybrid_method
+    def of_account(self, account_id: int):
+        return self.account_id == account_id
+
+    @hybrid_property
+    def by_date(self):
+        return (self.created_at, self.id)
+
+
+class Snapshot(Base):
+    """
+    Snapshot model. Open residues of an account, folded from the ledger up to a point in time.
+    Residues are stored as [[entry_id, residue, expires_on], ...].
+    """
+
+    __tablename__ = "snapshots"
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(None, ForeignKey("accounts.id"))
+    taken_at = Column(DateTime, nullable=False)
+    balance = Column(Integer, nullable=False)
+    residues = Column(JSONB, nullable=False)
+
+    def load_residues(self):
+        """
+        Get residues as a dictionary of entry id to residue and expiration.
+        """
+        return {
+            entry_id: (residue, datetime.date.fromisoformat(expires_on))
+            for entry_id, residue, expires_on in self.residues
+        }
+
+
 @listens_for(SyncSession, "before_flush")
 def recalculate_residue(session: Session, flush_context: UOWTransaction, instances):
     """
-    Recalculate residue for all created or changed entries.
+    Recalculate residue for all created or changed entries, except those already
+    settled before the flush, see settle_entries().
     """
 
+    settled = session.info.pop("settled_entries", set())
+
     for instance in session.new:
-        if isinstance(instance, Entry):
+        if isinstance(instance, Entry) and not instance in settled:
             instance.recalculate_residue(session)
 
     for instance in session.dirty:
-        if isinstance(instance, Entry):
+        if isinstance(instance, Entry) and not instance in settled:
             instance.recalculate_residue(session)
 
 
+@listens_for(SyncSession, "after_flush")
+def bump_organization_versions(session: Session, flush_context: UOWTransaction):
+    """
+    Bump data version of organizations whose accounts were created or changed,
+    in the same transaction so every worker sees it along with the changes.
+    """
+
+    changed = {
+        instance.organization_id
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, Account)
+    }
+
+    if changed:
+        session.connection().execute(
+            update(Organization.__table__)
+            .where(Organization.id.in_(changed))
+            .values(version=Organization.version + 1)
+        )
+
+
+@listens_for(SyncSession, "after_flush")
+def record_ledger_events(session: Session, flush_context: UOWTransaction):
+    """
+    Append residue changes of all created or changed entries to the ledger.
+    """
+
+    events = []
+    now = datetime.datetime.now()
+
+    def record(entry: Entry, kind: str, delta: int):
+        events.append(
+            {
+                "account_id": entry.account_id,
+                "entry_id": entry.id,
+                "created_at": now,
+                "kind": kind,
+                "delta": delta,
+                "expires_on": entry.expires_on,
+            }
+        )
+
+    for instance in session.new:
+        if isinstance(instance, Entry):
+            initial = round(instance.value * instance.multiplier)
+            record(instance, "created", initial)
+            if instance.residue != initial:
+                record(instance, "settled", instance.residue - initial)
+
+    for instance in session.dirty:
+        if isinstance(instance, Entry):
+            history = get_history(instance, "residue")
+            if history.added and history.deleted:
+                delta = history.added[0] - history.deleted[0]
+                if delta:
+                    record(instance, "settled", delta)
+
+    if events:
+        session.connection().execute(insert(LedgerEvent.__table__), events)
+
+
 Account.balance = column_property(
     func.coalesce(func.sum(Entry.residue).filter(Entry.active), 0).label("balance"),
     deferred=True,
     raiseload=True,
 )
+
+
+async def archive_entries(session: AsyncSession, before: datetime.date):
+    """
+    Move entries that expired before given date and have no residue left to the archive
+    partition. Entries that expired unused keep their residue and stay live, so history
+    may interleave live and archived entries.
+    """
+
+    result = await session.execute(
+        update(Entry)
+        .where(Entry.live, Entry.residue == 0, Entry.expires_on < before)
+        .values(archived=True)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def settle_entries(session: SyncSession, ids: list[int], on_progress=None):
+    """
+    Settle residue of entries already in the database, e.g. inserted in bulk.
+    Settled entries are marked so the flush doesn't recalculate them again
+    against stale database values. Doesn't flush.
+    """
+
+    with session.no_autoflush:
+        entries = session.scalars(select(Entry).where(Entry.id.in_(ids))).all()
+        for i, entry in enumerate(entries, 1):
+            entry.recalculate_residue(session)
+            if on_progress:
+                on_progress(i, len(entries))
+
+        settled = session.info.setdefault("settled_entries", set())
+        settled.update(e for e in session.dirty if isinstance(e, Entry))
+        settled.update(entries)
+
+
+async def credit_accounts(
+    session: AsyncSession,
+    organization_id: int,
+    account_ids: list[int],
+    happened_on: datetime.date,
+    expires_on: datetime.date,
+    value: int,
+    multiplier: float,
+    on_progress=None,
+):
+    """
+    Create the same entry for many active accounts of an organization in a single
+    INSERT, then settle the residue of each new entry. Doesn't commit.
+    """
+
+    ids = (
+        await session.scalars(
+            insert(Entry)
+            .from_select(
+                [
+                    "account_id",
+                    "created_at",
+                    "happened_on",
+                    "expires_on",
+                    "value",
+                    "residue",
+                    "multiplier",
+                ],
+                select(
+                    Account.id,
+                    func.now(),
+                    literal(happened_on),
+                    literal(expires_on),
+                    literal(value),
+                    literal(round(value * multiplier)),
+                    literal(multiplier),
+                ).where(
+                    Account.of_organization(organization_id),
+                    Account.active,
+                    Account.id.in_(account_ids),
+                ),
+            )
+            .returning(Entry.id)
+        )
+    ).all()
+
+    await session.execute(
+        insert(LedgerEvent).from_select(
+            ["account_id", "entry_id", "created_at", "kind", "delta", "expires_on"],
+            select(
+                Entry.account_id,
+                Entry.id,
+                literal(datetime.datetime.now()),
+                literal("created"),
+                Entry.residue,
+                Entry.expires_on,
+            ).where(Entry.live, Entry.id.in_(ids)),
+        )
+    )
+
+    await session.run_sync(settle_entries, ids, on_progress)
+
+    return ids
+
+
+async def forecast_balance(
+    session: AsyncSession,
+    start: datetime.date,
+    months: int,
+    organization_id: int = None,
+    account_id: int = None,
+):
+    """
+    Project the balance of an account, or every active account of an organization,
+    over the next months if nothing changes. Active residues are loaded once,
+    already summed by account and month of expiration.
+    """
+
+    # Truncating a date gives a timestamp with time zone, so cast it back to a date.
+    month = func.date_trunc(literal_column("'month'"), Entry.expires_on).cast(Date)
+
+    query = (
+        select(Entry.account_id, month, func.sum(Entry.residue))
+        .where(Entry.active)
+        .group_by(Entry.account_id, month)
+    )
+
+    if account_id:
+        query = query.where(Entry.of_account(account_id))
+    else:
+        query = query.join(Entry.account).where(
+            Account.of_organization(organization_id), Account.active
+        )
+
+    forecast = {}
+
+    for id, expires_on, residue in await session.execute(query):
+        if not id in forecast:
+            forecast[id] = {"balance": 0, "expiring": [0] * months}
+        i = (expires_on.year - start.year) * 12 + expires_on.month - start.month
+        if i < months:
+            forecast[id]["expiring"][i] += residue
+        forecast[id]["balance"] += residue
+
+    for item in forecast.values():
+        balance = item["balance"]
+        item["projected"] = []
+        for expiring in item["expiring"]:
+            balance -= expiring
+            item["projected"].append(balance)
+
+    return forecast
+
+
+def fold_residues(residues: dict, events: list[LedgerEvent]):
+    """
+    Apply ledger events to residues, a dictionary of entry id to residue and expiration.
+    """
+
+    for event in events:
+        residue = residues.get(event.entry_id, (0, event.expires_on))[0] + event.delta
+        if residue:
+            residues[event.entry_id] = (residue, event.expires_on)
+        else:
+            residues.pop(event.entry_id, None)
+    return residues
+
+
+def sum_residues(residues: dict, date: datetime.date):
+    """
+    Sum residues that haven't expired by given date.
+    """
+
+    return sum(
+        residue for residue, expires_on in residues.values() if expires_on >= date
+    )
+
+
+async def balance_as_of(session: AsyncSession, account_id: int, date: datetime.date):
+    """
+    Get account balance at the end of given date, from the latest snapshot
+    before it and the ledger events that followed.
+    """
+
+    moment = datetime.datetime.combine(
+        date + datetime.timedelta(days=1), datetime.time()
+    )
+
+    snapshot = await session.scalar(
+        select(Snapshot)
+        .where(Snapshot.account_id == account_id, Snapshot.taken_at <= moment)
+        .order_by(Snapshot.taken_at.desc())
+        .limit(1)
+    )
+
+    query = select(LedgerEvent).where(
+        LedgerEvent.of_account(account_id), LedgerEvent.created_at < moment
+    )
+
+    if snapshot:
+        query = query.where(LedgerEvent.created_at >= snapshot.taken_at)
+
+    residues = snapshot.load_residues() if snapshot else {}
+    events = await session.all(query.order_by(*LedgerEvent.by_date))
+
+    return sum_residues(fold_residues(residues, events), date)
+
+
+async def balance_changes(
+    session: AsyncSession,
+    account_id: int,
+    since: datetime.datetime,
+    until: datetime.datetime,
+):
+    """
+    List ledger events of an account in given period, i.e. why its balance changed.
+    """
+
+    return await session.all(
+        select(LedgerEvent)
+        .where(
+            LedgerEvent.of_account(account_id),
+            LedgerEvent.created_at >= since,
+            LedgerEvent.created_at < until,
+        )
+        .order_by(*LedgerEvent.by_date)
+    )
+
+
+async def take_snapshots(session: AsyncSession, until: datetime.datetime):
+    """
+    Take a new snapshot of every account with ledger events since its latest snapshot,
+    folding events up to given moment. Events are streamed in a single query. Doesn't commit.
+    """
+
+    latest = (
+        select(Snapshot)
+        .distinct(Snapshot.account_id)
+        .order_by(Snapshot.account_id, Snapshot.taken_at.desc())
+        .subquery()
+    )
+
+    snapshots = {
+        snapshot.account_id: snapshot
+        for snapshot in await session.all(select(aliased(Snapshot, latest)))
+    }
+
+    events = await session.stream_scalars(
+        select(LedgerEvent)
+        .outerjoin(latest, latest.c.account_id == LedgerEvent.account_id)
+        .where(
+            LedgerEvent.created_at < until,
+            or_(
+                latest.c.taken_at == None,
+                LedgerEvent.created_at >= latest.c.taken_at,
+            ),
+        )
+        .order_by(LedgerEvent.account_id, *LedgerEvent.by_date)
+        .execution_options(yield_per=1000)
+    )
+
+    count = 0
+    account_id = None
+    residues = {}
+
+    def take_snapshot():
+        for entry_id, (_, expires_on) in list(residues.items()):
+            if expires_on < until.date():
+                del residues[entry_id]
+        session.add(
+            Snapshot(
+                account_id=account_id,
+                taken_at=until,
+                balance=sum_residues(residues, until.date()),
+                residues=[
+                    [entry_id, residue, expires_on.isoformat()]
+                    for entry_id, (residue, expires_on) in residues.items()
+                ],
+            )
+        )
+
+    async for event in events:
+        if event.account_id != account_id:
+            if account_id is not None:
+                take_snapshot()
+                count += 1
+            account_id = event.account_id
+            snapshot = snapshots.get(account_id)
+            residues = snapshot.load_residues() if snapshot else {}
+        fold_residues(residues, [event])
+
+    if account_id is not None:
+        take_snapshot()
+        count += 1
+
+    return count
+
+
+# Accounts listing per organization, see list_accounts().
+accounts_cache = Cache(maxsize=1024)
+
+
+async def list_accounts(session: AsyncSession, organization: Organization):
+    """
+    List id, name and active of an organization's accounts. Served from memory until its accounts change.
+    """
+
+    try:
+        cached_version, accounts = accounts_cache[organization.id]
+        if cached_version == organization.version:
+            return accounts
+    except KeyError:
+        pass
+
+    accounts = (
+        await session.execute(
+            select(Account.id, Account.name, Account.active)
+            .where(Account.of_organization(organization.id))
+            .order_by(*Account.by_name)
+        )
+    ).all()
+
+    accounts_cache[organization.id] = (organization.version, accounts)
+
+    return accounts
@@ -0,0 +1,87 @@
+from email.message import EmailMessage
+from sqlalchemy.future import select
+
+from database import Session, Account, Entry
+from ext.mail import get_sender
+
+import config
+import logging
+import asyncio
+import datetime
+
+# Logger instance.
+log = logging.getLogger("digest")
+
+# Number of accounts rendered at a time.
+BATCH_SIZE = 1000
+
+
+def render(template, account, until: datetime.date):
+    """
+    Render digest message of an account.
+    """
+    message = EmailMessage()
+    message["From"] = config.MAIL_FROM
+    message["To"] = account.email
+    message["Subject"] = "Horas a vencer"
+    message.set_content(
+        template.render(
+            name=account.name,
+            balance=account.balance,
+            expiring_balance=account.expiring_balance,
+            # Last day included in the period, since it ends before until.
+            until=until - datetime.timedelta(days=1),
+        )
+    )
+    return message
+
+
+async def main():
+    today = datetime.date.today()
+    until = today + datetime.timedelta(days=config.DIGEST_WINDOW)
+    template = config.templates.get_template("digest.txt")
+    sender = get_sender(str(config.MAIL_URL))
+    semaphore = asyncio.Semaphore(config.DIGEST_CONCURRENCY)
+    count = 0
+
+    async def send(message: EmailMessage):
+        async with semaphore:
+            try:
+                await sender.send(message)
+            except Exception as exception:
+                log.exception(
+                    msg=f"Couldn't send to {message['To']}", exc_info=exception
+                )
+
+    expiring_balance = Account.expiring_balance(today, until)
+
+    try:
+        async with Session() as session:
+            result = await session.stream(
+                select(
+                    Account.email,
+                    Account.name,
+                    Account.balance,
+                    expiring_balance,
+                )
+                .outerjoin(Entry, (Entry.account_id == Account.id) & Entry.live)
+                .where(Account.active)
+                .group_by(Account.id)
+                .having(expiring_balance > 0)
+                .order_by(Account.organization_id, Account.id)
+                .execution_options(yield_per=BATCH_SIZE)
+            )
+
+            async for batch in result.partitions():
+                messages = [render(template, account, until) for account in batch]
+                await asyncio.gather(*(send(message) for message in messages))
+                count += len(messages)
+                log.info(f"Sent {count} digests.")
+    finally:
+        sender.close()
+
+
+# Run once, e.g. weekly from cron.
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
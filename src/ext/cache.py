@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class Cache(OrderedDict):
+    """
+    A dictionary-like object that discards least recently used items past a maximum size.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key: any):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: any, value: any):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Cache rendered template fragments in memory, e.g.
+
+        {% cache ("name", version) %}...{% endcache %}
+
+    The key must change whenever the data rendered inside the block does.
+    """
+
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=Cache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render", args), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, key: any, caller):
+        try:
+            return self.environment.fragment_cache[key]
+        except KeyError:
+            value = self.environment.fragment_cache[key] = caller()
+            return value
@@ -0,0 +1,93 @@
+from collections import Counter
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import os
+import hmac
+import sys
+import time
+import random
+import threading
+
+
+class Sampler:
+    """
+    Sample the call stack of a thread at a fixed interval, in a background thread.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        """
+        Get samples in collapsed stack format, as read by flamegraph.pl or speedscope.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
+
+
+class ProfilerMiddleware:
+    """
+    Profile a random fraction of requests, or requests carrying the profile header
+    with the right token, and write collapsed stacks to a directory.
+
+    Samples are taken from the event loop thread, so concurrent requests show up too.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        directory: str,
+        sample_rate: float = 0.0,
+        token: str = "",
+        header: str = "x-profile",
+    ) -> None:
+        self.app = app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token.encode()
+        self.header = header.encode()
+
+    def should_profile(self, scope: Scope):
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == self.header and hmac.compare_digest(value, self.token):
+                    return True
+        return random.random() < self.sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        sampler = Sampler(threading.get_ident())
+        sampler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.stop()
+            path = scope["path"].strip("/").replace("/", "_") or "root"
+            filename = f"{time.time_ns()}-{scope['method']}-{path}.collapsed"
+            with open(os.path.join(self.directory, filename), "w") as file:
+                file.write(sampler.collapsed())
@@ -71,12 +71,13 @@ class Google:
         """
         return self.session.post(url=self.revoke_url, params={"token": self.token})
 
-    def is_holiday(self, date: datetime.date, calendar_id: str = default_calendar_id):
+    def fetch_holidays(self, calendar_id: str = default_calendar_id):
         """
-        Use Google Calendar to check if a given date is a holiday.
+        Fetch holidays from Google Calendar, as (start, end) date ranges with exclusive end.
         """
         response = self.session.get(f"{self.calendar_base_url}/{calendar_id}/events")
         data = response.json()
+        holidays = []
         for item in data["items"]:
             try:
                 start = datetime.date.fromisoformat(item["start"]["date"])
@@ -92,5 +93,13 @@ class Google:
                 except KeyError:
                     continue
 
-            if start <= date < end:
-                return True
+            holidays.append((start, end))
+        return holidays
+
+    def is_holiday(self, date: datetime.date, calendar_id: str = default_calendar_id):
+        """
+        Use Google Calendar to check if a given date is a holiday.
+        """
+        return any(
+            start <= date < end for start, end in self.fetch_holidays(calendar_id)
+        )
@@ -8,21 +8,36 @@ from starlette.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.applications import Starlette
-from starlette.responses import RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse
 from starlette.staticfiles import StaticFiles
 from starlette.endpoints import HTTPEndpoint
 from starlette.exceptions import HTTPException
 from starlette.routing import Route, Mount
 from starlette.requests import HTTPConnection, Request
+from starlette.concurrency import run_in_threadpool
 
 from sqlalchemy.future import select
-from sqlalchemy import orm, func
-
-from database import DatabaseMiddleware, Session, Organization, Account, Entry
+from sqlalchemy import orm, func, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import (
+    DatabaseMiddleware,
+    Session,
+    Organization,
+    Account,
+    Entry,
+    balance_as_of,
+    balance_changes,
+    credit_accounts,
+    forecast_balance,
+    list_accounts,
+)
 
 from google import Google
 
 from ext.flash import FlashMiddleware
+from ext.profiler import ProfilerMiddleware
 
 import config
 import logging
@@ -136,6 +151,48 @@ class OAuthEndpoint(HTTPEndpoint):
         )
 
 
+def get_multiplier(
+    request: Request, happened_on: datetime.date, holidays: list[tuple] = None
+):
+    """
+    Get value multiplier of entries that happened on given date, e.g. Sundays and holidays.
+    Holidays are fetched from Google unless given, see Google.fetch_holidays().
+    """
+    organization = request.user.organization
+    if happened_on.weekday() == 6:
+        return organization.settings["holiday_multiplier"]
+    if holidays is None:
+        holidays = Google(request).fetch_holidays()
+    if any(start <= happened_on < end for start, end in holidays):
+        return organization.settings["holiday_multiplier"]
+    return 1.0
+
+
+def build_entry(
+    request: Request,
+    happened_on: datetime.date,
+    value: int,
+    multiplier: float = None,
+    **kwargs,
+):
+    """
+    Build a new entry for the current user, following organization settings.
+    """
+    organization = request.user.organization
+    if multiplier is None:
+        multiplier = get_multiplier(request, happened_on)
+    return Entry(
+        account_id=request.user.id,
+        happened_on=happened_on,
+        expires_on=happened_on
+        + datetime.timedelta(days=organization.settings["expires_in"]),
+        value=value,
+        residue=round(value * multiplier),
+        multiplier=multiplier,
+        **kwargs,
+    )
+
+
 class NewEntryEndpoint(HTTPEndpoint):
     @requires("authenticated", redirect="sign_in")
     async def get(self, request: Request):
@@ -150,36 +207,70 @@ class NewEntryEndpoint(HTTPEndpoint):
 
 class EntriesEndpoint(HTTPEndpoint):
     @requires("authenticated", redirect="sign_in")
+    async def post(self, request: Request):
+        form = await request.form()
+        request.db.add(
+            build_entry(
+                request,
+                happened_on=datetime.date.fromisoformat(form["happened_on"]),
+                value=int(form["value"]),
+            )
+        )
+        await request.db.commit()
+        request.flash["alert"] = {"message": "✅ Registro criado.", "type": "positive"}
+        return RedirectResponse(url=request.url_for(name="new_entry"), status_code=303)
+
+
+class BatchEntriesEndpoint(HTTPEndpoint):
+    @requires(["authenticated", "manager"], redirect="sign_in")
+    async def get(self, request: Request):
+        accounts = await list_accounts(request.db, request.user.organization)
+        return config.templates.TemplateResponse(
+            "batch_entry.html",
+            {
+                "request": request,
+                "is_management": True,
+                "accounts": [a for a in accounts if a.active],
+                "today": datetime.date.today(),
+            },
+        )
+
+    @requires(["authenticated", "manager"], redirect="sign_in")
     async def post(self, request: Request):
         organization = request.user.organization
         form = await request.form()
+        account_ids = [int(id) for id in form.getlist("account_id")]
         happened_on = datetime.date.fromisoformat(form["happened_on"])
         expires_on = happened_on + datetime.timedelta(
             days=organization.settings["expires_in"]
         )
-        multiplier = 1.0
-        if happened_on.weekday == 6:
-            multiplier = organization.settings["holiday_multiplier"]
-        else:
-            google = Google(request)
-            if google.is_holiday(happened_on):
-                multiplier = organization.settings["holiday_multiplier"]
 
-        value = int(form["value"])
-        residue = round(value * multiplier)
-        request.db.add(
-            Entry(
-                account_id=request.user.id,
-                happened_on=happened_on,
-                expires_on=expires_on,
-                value=value,
-                residue=residue,
-                multiplier=multiplier,
-            )
+        def report_progress(done: int, total: int):
+            if done % 100 == 0 or done == total:
+                log.info(
+                    f"Batch entry for organization {organization.id}: {done}/{total}."
+                )
+
+        holidays = await run_in_threadpool(Google(request).fetch_holidays)
+
+        ids = await credit_accounts(
+            request.db,
+            organization_id=organization.id,
+            account_ids=account_ids,
+            happened_on=happened_on,
+            expires_on=expires_on,
+            value=int(form["value"]),
+            multiplier=get_multiplier(request, happened_on, holidays),
+            on_progress=report_progress,
         )
         await request.db.commit()
-        request.flash["alert"] = {"message": "✅ Registro criado.", "type": "positive"}
-        return RedirectResponse(url=request.url_for(name="new_entry"), status_code=303)
+        request.flash["alert"] = {
+            "message": f"✅ Registros criados: {len(ids)}.",
+            "type": "positive",
+        }
+        return RedirectResponse(
+            url=request.url_for(name="batch_entries"), status_code=303
+        )
 
 
 class SummaryEndpoint(HTTPEndpoint):
@@ -220,14 +311,77 @@ class SummaryEndpoint(HTTPEndpoint):
         )
 
 
+class ForecastEndpoint(HTTPEndpoint):
+    # Whether to forecast the whole organization instead of the current user.
+    is_management = False
+
+    def get_months(self, value: str):
+        try:
+            return min(max(int(value), 1), 24)
+        except (TypeError, ValueError):
+            return 6
+
+    @requires("authenticated", redirect="sign_in")
+    async def get(self, request: Request):
+        organization_id = request.user.organization_id
+        is_management = self.is_management
+
+        if is_management and not request.user.is_manager:
+            raise HTTPException(status_code=404)
+
+        start = datetime.date.today().replace(day=1)
+        months = self.get_months(request.query_params.get("months"))
+        period = [
+            start.replace(
+                year=start.year + (start.month - 1 + i) // 12,
+                month=(start.month - 1 + i) % 12 + 1,
+            )
+            for i in range(months)
+        ]
+
+        if is_management:
+            accounts = [
+                a
+                for a in await list_accounts(request.db, request.user.organization)
+                if a.active
+            ]
+            forecast = await forecast_balance(
+                request.db, start, months, organization_id=organization_id
+            )
+        else:
+            accounts = [request.user]
+            forecast = await forecast_balance(
+                request.db, start, months, account_id=request.user.id
+            )
+
+        empty = {"balance": 0, "expiring": [0] * months, "projected": [0] * months}
+        rows = [(a, forecast.get(a.id, empty)) for a in accounts]
+        total = {"expiring": [0] * months, "projected": [0] * months}
+        for _, item in rows:
+            for key in total:
+                total[key] = [a + b for a, b in zip(total[key], item[key])]
+
+        return config.templates.TemplateResponse(
+            "forecast.html",
+            {
+                "request": request,
+                "is_management": is_management,
+                "period": period,
+                "months": months,
+                "rows": rows,
+                "total": total,
+            },
+        )
+
+
+class OrganizationForecastEndpoint(ForecastEndpoint):
+    is_management = True
+
+
 class AccountsEndpoint(HTTPEndpoint):
     @requires(["authenticated", "manager"], redirect="sign_in")
     async def get(self, request: Request):
-        accounts = await request.db.all(
-            select(Account)
-            .where(Account.of_organization(request.user.organization.id))
-            .order_by(*Account.by_name)
-        )
+        accounts = await list_accounts(request.db, request.user.organization)
         return config.templates.TemplateResponse(
             "accounts.html",
             {
@@ -238,6 +392,68 @@ class AccountsEndpoint(HTTPEndpoint):
         )
 
 
+def get_cursor(value: str):
+    """
+    Parse history cursor from query string, i.e. the sort key of the last entry
+    of the previous page. Defaults to the first page.
+    """
+    try:
+        happened_on, created_at, id = value.split("_")
+        return (
+            datetime.date.fromisoformat(happened_on),
+            datetime.datetime.fromisoformat(created_at),
+            int(id),
+        )
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_cursor(entry: Entry):
+    """
+    Format history cursor pointing past given entry.
+    """
+    return f"{entry.happened_on.isoformat()}_{entry.created_at.isoformat()}_{entry.id}"
+
+
+async def get_history(db: AsyncSession, account_id: int, before: tuple = None):
+    """
+    Get a page of account's entries, newest first, and the cursor of the next page.
+    Archived entries are mostly older than live ones, so they're only read once the
+    page reaches the newest of them, and then merged with the live ones.
+    """
+    size = config.HISTORY_PAGE_SIZE
+
+    def page(*criteria):
+        query = select(Entry).where(Entry.of_account(account_id), *criteria)
+        if before:
+            query = query.where(
+                tuple_(Entry.happened_on, Entry.created_at, Entry.id) < tuple_(*before)
+            )
+        return db.all(query.order_by(*Entry.by_date).limit(size + 1))
+
+    entries = await page(Entry.live)
+
+    newest_archived = await db.scalar(
+        select(func.max(Entry.happened_on)).where(
+            Entry.of_account(account_id), Entry.archived == True
+        )
+    )
+
+    if newest_archived and (
+        len(entries) <= size or newest_archived >= entries[-1].happened_on
+    ):
+        entries = sorted(
+            entries + await page(Entry.archived == True),
+            key=lambda entry: (entry.happened_on, entry.created_at, entry.id),
+            reverse=True,
+        )
+
+    if len(entries) > size:
+        return entries[:size], format_cursor(entries[size - 1])
+
+    return entries, None
+
+
 class AccountEndpoint(HTTPEndpoint):
     @requires("authenticated", redirect="sign_in")
     async def get(self, request: Request):
@@ -258,17 +474,12 @@ class AccountEndpoint(HTTPEndpoint):
         )
 
         if is_management:
-            accounts = await request.db.all(
-                select(Account)
-                .where(Account.of_organization(organization_id))
-                .order_by(*Account.by_name)
-            )
+            accounts = await list_accounts(request.db, request.user.organization)
         else:
             accounts = []
 
-        entries_by_date = await request.db.all(
-            select(Entry).where(Entry.of_account(account_id)).order_by(*Entry.by_date)
-        )
+        before = get_cursor(request.query_params.get("before"))
+        entries_by_date, next = await get_history(request.db, account_id, before)
 
         entries_by_expiration = await request.db.all(
             select(Entry)
@@ -287,6 +498,8 @@ class AccountEndpoint(HTTPEndpoint):
                 "accounts": accounts,
                 "account": account,
                 "entries_by_date": entries_by_date,
+                "is_first_page": not before,
+                "next": next,
                 "entries_by_expiration": entries_by_expiration,
             },
         )
@@ -323,12 +536,225 @@ class SettingsEndpoint(HTTPEndpoint):
         return RedirectResponse(url=request.url_for(name="settings"), status_code=303)
 
 
+# Fields of entries exposed by the API.
+API_ENTRY_FIELDS = (
+    "id",
+    "client_id",
+    "happened_on",
+    "expires_on",
+    "value",
+    "residue",
+    "multiplier",
+)
+
+# Maximum number of entries accepted by a single sync request.
+API_SYNC_LIMIT = 500
+
+
+def get_fields(value: str):
+    """
+    Parse fields selection from query string, e.g. ?fields=id,value. Defaults to all fields.
+    """
+    if not value:
+        return API_ENTRY_FIELDS
+    fields = tuple(value.split(","))
+    if not set(fields) <= set(API_ENTRY_FIELDS):
+        raise HTTPException(status_code=400)
+    return fields
+
+
+def serialize_entry(entry: Entry, fields: tuple[str] = API_ENTRY_FIELDS):
+    """
+    Serialize given fields of an entry to JSON compatible values.
+    """
+    data = {}
+    for field in fields:
+        value = getattr(entry, field)
+        if isinstance(value, datetime.date):
+            value = value.isoformat()
+        data[field] = value
+    return data
+
+
+async def parse_entries(request: Request):
+    """
+    Parse new entries from JSON request body, i.e. {"entries": [{...}, ...]}.
+    """
+    try:
+        data = await request.json()
+        return [
+            {
+                "happened_on": datetime.date.fromisoformat(item["happened_on"]),
+                "value": int(item["value"]),
+                "client_id": str(item["client_id"]) if "client_id" in item else None,
+            }
+            for item in data["entries"]
+        ]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400)
+
+
+def get_date(value: str, default: datetime.date = None):
+    """
+    Parse ISO date from query string.
+    """
+    if not value:
+        return default
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400)
+
+
+class ApiBalanceEndpoint(HTTPEndpoint):
+    @requires("authenticated")
+    async def get(self, request: Request):
+        as_of = get_date(request.query_params.get("as_of"))
+        if as_of:
+            balance = await balance_as_of(request.db, request.user.id, as_of)
+            return JSONResponse({"balance": balance, "as_of": as_of.isoformat()})
+        balance = await request.db.scalar(
+            select(func.coalesce(func.sum(Entry.residue), 0)).where(
+                Entry.of_account(request.user.id), Entry.active
+            )
+        )
+        return JSONResponse({"balance": balance})
+
+
+class ApiLedgerEndpoint(HTTPEndpoint):
+    @requires("authenticated")
+    async def get(self, request: Request):
+        """
+        List changes to the balance in a period, i.e. ?since=2022-01-01&until=2022-02-01.
+        """
+        today = datetime.date.today()
+        since = get_date(request.query_params.get("since"), today.replace(day=1))
+        until = get_date(request.query_params.get("until"), today)
+        events = await balance_changes(
+            request.db,
+            request.user.id,
+            datetime.datetime.combine(since, datetime.time()),
+            datetime.datetime.combine(
+                until + datetime.timedelta(days=1), datetime.time()
+            ),
+        )
+        return JSONResponse(
+            {
+                "events": [
+                    {
+                        "entry_id": event.entry_id,
+                        "created_at": event.created_at.isoformat(),
+                        "kind": event.kind,
+                        "delta": event.delta,
+                        "expires_on": event.expires_on.isoformat(),
+                    }
+                    for event in events
+                ]
+            }
+        )
+
+
+class ApiEntriesEndpoint(HTTPEndpoint):
+    @requires("authenticated")
+    async def get(self, request: Request):
+        fields = get_fields(request.query_params.get("fields"))
+        before = get_cursor(request.query_params.get("before"))
+        entries, next = await get_history(request.db, request.user.id, before)
+        return JSONResponse(
+            {
+                "entries": [serialize_entry(entry, fields) for entry in entries],
+                "next": next,
+            }
+        )
+
+    @requires("authenticated")
+    async def post(self, request: Request):
+        try:
+            data = await request.json()
+            happened_on = datetime.date.fromisoformat(data["happened_on"])
+            value = int(data["value"])
+        except (ValueError, TypeError, KeyError):
+            raise HTTPException(status_code=400)
+        holidays = await run_in_threadpool(Google(request).fetch_holidays)
+        entry = build_entry(
+            request,
+            happened_on=happened_on,
+            value=value,
+            multiplier=get_multiplier(request, happened_on, holidays),
+        )
+        request.db.add(entry)
+        await request.db.commit()
+        return JSONResponse(serialize_entry(entry), status_code=201)
+
+
+class ApiSyncEndpoint(HTTPEndpoint):
+    @requires("authenticated")
+    async def post(self, request: Request):
+        """
+        Create entries queued offline. Entries are identified by client generated ids
+        so sending the same entries again doesn't create duplicates.
+        """
+        items = await parse_entries(request)
+
+        if len(items) > API_SYNC_LIMIT or any(not i["client_id"] for i in items):
+            raise HTTPException(status_code=400)
+
+        entries = dict(
+            (
+                await request.db.execute(
+                    select(Entry.client_id, Entry.id).where(
+                        Entry.of_account(request.user.id),
+                        Entry.client_id.in_([i["client_id"] for i in items]),
+                    )
+                )
+            ).all()
+        )
+
+        holidays = None
+        created = {}
+
+        # Entries are flushed one at a time, oldest first, so each one settles
+        # against the ones before it.
+        try:
+            for item in sorted(items, key=lambda i: i["happened_on"]):
+                if item["client_id"] in entries or item["client_id"] in created:
+                    continue
+                if holidays is None:
+                    holidays = await run_in_threadpool(Google(request).fetch_holidays)
+                entry = build_entry(
+                    request,
+                    multiplier=get_multiplier(request, item["happened_on"], holidays),
+                    **item,
+                )
+                request.db.add(entry)
+                await request.db.flush()
+                created[item["client_id"]] = entry
+
+            await request.db.commit()
+        except IntegrityError:
+            raise HTTPException(status_code=409)
+
+        entries.update((id, entry.id) for id, entry in created.items())
+
+        return JSONResponse(
+            {
+                "entries": [
+                    {"client_id": i["client_id"], "id": entries[i["client_id"]]}
+                    for i in items
+                ],
+                "created": len(created),
+            }
+        )
+
+
 # Exception handler.
 async def handle_exception(request: Request, exception: HTTPException | Exception):
     try:
         status_code = exception.status_code
     except AttributeError:
         status_code = 500
+    if request.url.path.startswith("/api/"):
+        return JSONResponse({"status_code": status_code}, status_code=status_code)
     return config.templates.TemplateResponse(
         "error.html",
         {"request": request, "status_code": status_code},
@@ -349,16 +775,54 @@ routes = [
     Route("/entries", EntriesEndpoint, methods=["GET", "POST"], name="entries"),
     Route("/entries/new", NewEntryEndpoint, methods=["GET"], name="new_entry"),
     Route("/summary", SummaryEndpoint, methods=["GET"], name="summary"),
+    Route("/forecast", ForecastEndpoint, methods=["GET"], name="forecast"),
+    Route(
+        "/summary/forecast",
+        OrganizationForecastEndpoint,
+        methods=["GET"],
+        name="organization_forecast",
+    ),
     Route("/accounts", AccountsEndpoint, methods=["GET"], name="accounts"),
     Route("/account", AccountEndpoint, methods=["GET"], name="account"),
     Route("/accounts/{id:int}", AccountEndpoint, methods=["GET"], name="account"),
+    Route(
+        "/entries/batch",
+        BatchEntriesEndpoint,
+        methods=["GET", "POST"],
+        name="batch_entries",
+    ),
     Route("/settings", SettingsEndpoint, methods=["GET", "PATCH"], name="settings"),
+    Mount(
+        "/api/v1",
+        routes=[
+            Route("/balance", ApiBalanceEndpoint, methods=["GET"], name="balance"),
+            Route(
+                "/entries", ApiEntriesEndpoint, methods=["GET", "POST"], name="entries"
+            ),
+            Route("/sync", ApiSyncEndpoint, methods=["POST"], name="sync"),
+            Route("/ledger", ApiLedgerEndpoint, methods=["GET"], name="ledger"),
+        ],
+        name="api",
+    ),
 ]
 
+# Request profiling, when enabled.
+profiler = []
+if config.PROFILE_DIR:
+    profiler.append(
+        Middleware(
+            ProfilerMiddleware,
+            directory=config.PROFILE_DIR,
+            sample_rate=config.PROFILE_SAMPLE_RATE,
+            token=str(config.PROFILE_TOKEN),
+        )
+    )
+
 # Create Starlette application.
 app = Starlette(
     debug=config.DEBUG,
     middleware=[
+        *profiler,
         Middleware(
             SessionMiddleware,
             secret_key=config.SECRET_KEY,
@@ -0,0 +1,25 @@
+from database import Session, take_snapshots
+
+import logging
+import asyncio
+import datetime
+
+# Logger instance.
+log = logging.getLogger("snapshot")
+
+# Events newer than this are left for the next run, so transactions still in flight aren't missed.
+MARGIN = datetime.timedelta(minutes=5)
+
+
+async def main():
+    until = datetime.datetime.now() - MARGIN
+    async with Session() as session:
+        count = await take_snapshots(session, until)
+        await session.commit()
+    log.info(f"Took {count} snapshots up to {until}.")
+
+
+# Run periodically, e.g. hourly from cron.
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,167 @@
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session as SyncSession
+
+import os
+import sys
+import asyncio
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://test@localhost/test")
+os.environ.setdefault("GOOGLE_CLIENT_ID", "test")
+os.environ.setdefault("GOOGLE_CLIENT_SECRET", "test")
+
+from database import (
+    Base,
+    Organization,
+    Account,
+    Entry,
+    LedgerEvent,
+    archive_entries,
+    settle_entries,
+)
+
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://", future=True)
+        Base.metadata.create_all(
+            engine,
+            tables=[
+                Organization.__table__,
+                Account.__table__,
+                Entry.__table__,
+                LedgerEvent.__table__,
+            ],
+        )
+        self.session = SyncSession(engine, future=True)
+        self.session.add(Organization(id=1, domain="example.com"))
+        self.session.add(
+            Account(id=1, organization_id=1, email="a@example.com", name="A")
+        )
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def entry(self, value: int, **kwargs):
+        today = datetime.date.today()
+        return {
+            "account_id": 1,
+            "happened_on": today,
+            "expires_on": today + datetime.timedelta(days=90),
+            "value": value,
+            "residue": value,
+            "multiplier": 1.0,
+            **kwargs,
+        }
+
+
+class OrganizationVersionTest(DatabaseTest):
+    def version(self):
+        self.session.expire_all()
+        return self.session.get(Organization, 1).version
+
+    def test_bump_on_account_changes(self):
+        version = self.version()
+
+        self.session.add(Account(organization_id=1, email="b@example.com", name="B"))
+        self.session.commit()
+        self.assertEqual(self.version(), version + 1)
+
+        self.session.get(Account, 1).active = False
+        self.session.commit()
+        self.assertEqual(self.version(), version + 2)
+
+    def test_keep_on_rollback(self):
+        version = self.version()
+
+        self.session.add(Account(organization_id=1, email="b@example.com", name="B"))
+        self.session.flush()
+        self.session.rollback()
+        self.assertEqual(self.version(), version)
+
+
+class SettleEntriesTest(DatabaseTest):
+    def test_partially_settled_debit(self):
+        debit = Entry(**self.entry(-100))
+        self.session.add(debit)
+        self.session.commit()
+
+        # Inserted in bulk, like credit_accounts() does.
+        credit_id = self.session.execute(
+            insert(Entry.__table__).values(self.entry(60))
+        ).inserted_primary_key[0]
+
+        settle_entries(self.session, [credit_id])
+        self.session.commit()
+        self.session.expire_all()
+
+        self.assertEqual(self.session.get(Entry, debit.id).residue, -40)
+        self.assertEqual(self.session.get(Entry, credit_id).residue, 0)
+
+        events = self.session.execute(
+            LedgerEvent.__table__.select()
+            .where(LedgerEvent.kind == "settled")
+            .order_by(LedgerEvent.entry_id)
+        )
+        self.assertEqual(
+            [(event.entry_id, event.delta) for event in events],
+            [(debit.id, 60), (credit_id, -60)],
+        )
+
+
+class ArchiveEntriesTest(DatabaseTest):
+    class AsyncSession:
+        """
+        Just enough of AsyncSession to run archive_entries() on a sync session.
+        """
+
+        def __init__(self, session):
+            self.session = session
+
+        async def execute(self, statement):
+            return self.session.execute(statement)
+
+    def archive(self, before: datetime.date):
+        count = asyncio.run(archive_entries(self.AsyncSession(self.session), before))
+        self.session.commit()
+        return count
+
+    def test_archive_past_unused_credit(self):
+        today = datetime.date.today()
+        days = datetime.timedelta(days=1)
+
+        # Expired unused, so it keeps its residue and stays live.
+        unused_id = self.session.execute(
+            insert(Entry.__table__).values(
+                self.entry(
+                    30, happened_on=today - 200 * days, expires_on=today - 110 * days
+                )
+            )
+        ).inserted_primary_key[0]
+
+        settled_id = self.session.execute(
+            insert(Entry.__table__).values(
+                self.entry(
+                    60,
+                    happened_on=today - 100 * days,
+                    expires_on=today - 10 * days,
+                    residue=0,
+                )
+            )
+        ).inserted_primary_key[0]
+        self.session.commit()
+
+        self.assertEqual(self.archive(today), 1)
+        self.session.expire_all()
+
+        self.assertFalse(self.session.get(Entry, unused_id).archived)
+        self.assertTrue(self.session.get(Entry, settled_id).archived)
+
+
+if __name__ == "__main__":
+    unittest.main()